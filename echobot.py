@@ -1,23 +1,95 @@
+from __future__ import annotations
+
 import argparse
 import asyncio
+import collections
+import logging
+import logging.handlers
 import os
-import threading
+import queue
+import sys
 import time
+import weakref
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import LXMF
+    import RNS
+
+log = logging.getLogger("echobot")
+
 
-import LXMF
-import RNS
+def import_reticulum():
+    # RNS and LXMF are slow to import, so only pull them in once they are actually needed
+    global LXMF, RNS
+    import LXMF
+    import RNS
 
 
 class EchoBot:
 
+    __slots__ = (
+        "identity",
+        "display_name",
+        "path_lookup_timeout_seconds",
+        "negative_path_cache_seconds",
+        "inbound_worker_count",
+        "announce_interval_seconds",
+        "max_outbound_stamp_cost",
+        "max_cached_destinations",
+        "max_cached_entries_before_prune",
+        "destination_cache_ttl_seconds",
+        "online_nodes_cache_seconds",
+        "stamp_cost_cache_seconds",
+        "_path_events",
+        "_neg_path_cache",
+        "_stamp_cache",
+        "_announce_timer",
+        "_inbound_workers",
+        "_nodes_cache",
+        "_dest_cache",
+        "_out_dest_pool",
+        "_out_dest_built_at",
+        "loop",
+        "inbound_queue",
+        "reticulum",
+        "message_router",
+        "local_lxmf_destination",
+    )
+
+    # Announce handler config, used to be notified when a path to an lxmf peer becomes known
+    aspect_filter = "lxmf.delivery"
+    receive_path_responses = True
+
     def __init__(self, identity: RNS.Identity, display_name: str, announce_interval_seconds: int | None = None, max_outbound_stamp_cost: int | None = None):
 
+        import_reticulum()
+
         self.identity = identity
         self.display_name = display_name
         self.path_lookup_timeout_seconds = 15
+        self.negative_path_cache_seconds = 30
+        self.inbound_worker_count = 4
         self.announce_interval_seconds = announce_interval_seconds
         self.max_outbound_stamp_cost = max_outbound_stamp_cost
-        self.last_announced_at = None
+        self.max_cached_destinations = 1024
+        self.max_cached_entries_before_prune = 1024
+        self.destination_cache_ttl_seconds = 300
+        self.online_nodes_cache_seconds = 1.0
+        self.stamp_cost_cache_seconds = 30
+        self._path_events: dict[bytes, asyncio.Event] = {}
+        self._neg_path_cache: dict[bytes, float] = {}
+        self._stamp_cache: dict[bytes, tuple[float, int | None]] = {}
+        self._announce_timer: asyncio.TimerHandle | None = None
+        self._inbound_workers: list[asyncio.Task] = []
+        self._nodes_cache: tuple[float, int | None, list[dict]] = (0.0, None, [])
+        self._dest_cache: collections.OrderedDict[bytes, tuple[float, bytes | None, RNS.Destination]] = collections.OrderedDict()
+        self._out_dest_pool: weakref.WeakValueDictionary[tuple[bytes, bytes | None], RNS.Destination] = weakref.WeakValueDictionary()
+        self._out_dest_built_at: weakref.WeakKeyDictionary[RNS.Destination, float] = weakref.WeakKeyDictionary()
+
+        # Inbound messages are handed over from the LXMF callback thread and replied to on this loop
+        self.loop = asyncio.new_event_loop()
+        self.inbound_queue: asyncio.Queue[LXMF.LXMessage] = asyncio.Queue()
 
         # Init RNS
         self.reticulum = RNS.Reticulum()
@@ -34,75 +106,241 @@ class EchoBot:
         # Set callback for inbound messages
         self.message_router.register_delivery_callback(self.on_lxmf_message_received)
 
+        # Listen for announces and path responses, so path lookups can wake up as soon as they resolve
+        RNS.Transport.register_announce_handler(self)
+
         # Announce now
         self.announce()
 
-        # Start auto announce thread
-        thread = threading.Thread(target=self.announce_loop)
-        thread.daemon = True
-        thread.start()
+        # Start inbound workers
+        for _ in range(self.inbound_worker_count):
+            self._inbound_workers.append(self.loop.create_task(self.inbound_worker()))
 
-    def announce_loop(self):
-        while True:
-            should_announce = False
-            if self.announce_interval_seconds and self.announce_interval_seconds > 0:
-                if self.last_announced_at is None or time.time() > self.last_announced_at + self.announce_interval_seconds:
-                    should_announce = True
-            if should_announce:
-                self.announce()
-            time.sleep(1)
+        # Schedule auto announce
+        if self.announce_interval_seconds and self.announce_interval_seconds > 0:
+            self.schedule_announce(self.loop.time() + self.announce_interval_seconds)
+
+    def schedule_announce(self, announce_at: float):
+        self._announce_timer = self.loop.call_at(announce_at, self.announce_and_reschedule, announce_at)
+
+    def announce_and_reschedule(self, announced_at: float):
+        self.announce()
+
+        # keep to the original cadence, but don't try to catch up on announces missed while the loop was stalled
+        next_announce_at = announced_at + self.announce_interval_seconds
+        if next_announce_at <= self.loop.time():
+            next_announce_at = self.loop.time() + self.announce_interval_seconds
+        self.schedule_announce(next_announce_at)
 
     def announce(self):
-        self.last_announced_at = int(time.time())
         self.message_router.announce(destination_hash=self.local_lxmf_destination.hash)
 
-    def get_online_nodes_full(self, max_age_seconds=60):
-        nodes = {}
-        for iface in RNS.Transport.interfaces:
-            peers = getattr(iface, "peers", []) or []
-            for p in peers:
-                nodes[p.hex()] = {"interface": iface.name, "type": "peer"}
+    def run(self):
+        # blocks until interrupted, then shuts the bot down
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        # must be called once the event loop has stopped running
+        RNS.Transport.deregister_announce_handler(self)
+        if self._announce_timer is not None:
+            self._announce_timer.cancel()
+            self._announce_timer = None
+        for worker in self._inbound_workers:
+            worker.cancel()
+        self.loop.run_until_complete(asyncio.gather(*self._inbound_workers, return_exceptions=True))
+        self._inbound_workers.clear()
+        self.loop.close()
+
+    def received_announce(self, destination_hash, announced_identity, app_data):
+        self._neg_path_cache.pop(destination_hash, None)
+        # announces carry the peer's current stamp cost
+        self._stamp_cache.pop(destination_hash, None)
+        path_event = self._path_events.get(destination_hash)
+        if path_event is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(path_event.set)
+
+    def _prune_expired(self, cache: dict, is_expired):
+        # prune in place, as other threads pop from these caches while we hold a reference to them
+        if len(cache) > self.max_cached_entries_before_prune:
+            for expired_hash in [k for k, v in tuple(cache.items()) if is_expired(v)]:
+                cache.pop(expired_hash, None)
+
+    def _cache_path_not_found(self, destination_hash: bytes):
+        now = time.monotonic()
+        self._prune_expired(self._neg_path_cache, lambda expires_at: expires_at <= now)
+        self._neg_path_cache[destination_hash] = now + self.negative_path_cache_seconds
+
+    def _get_out_destination(self, destination_hash: bytes, ratchet_id: bytes | None) -> RNS.Destination | None:
+        # reuse the outbound destination for repeat senders, unless it is stale or their ratchet has changed
+        now = time.monotonic()
+        cached = self._dest_cache.get(destination_hash)
+        if cached is not None:
+            cached_at, cached_ratchet_id, lxmf_destination = cached
+            if now - cached_at < self.destination_cache_ttl_seconds and cached_ratchet_id == ratchet_id:
+                self._dest_cache.move_to_end(destination_hash)
+                return lxmf_destination
+            lxmf_destination = None
+        else:
+            # an evicted destination may still be alive, e.g. held by a queued reply, it is subject to the same checks
+            lxmf_destination = self._out_dest_pool.get((destination_hash, ratchet_id))
+            if lxmf_destination is not None:
+                cached_at = self._out_dest_built_at.get(lxmf_destination, 0)
+                if now - cached_at >= self.destination_cache_ttl_seconds:
+                    lxmf_destination = None
+
+        if lxmf_destination is None:
+            destination_identity = RNS.Identity.recall(destination_hash)
+            if destination_identity is None:
+                self._dest_cache.pop(destination_hash, None)
+                return None
+
+            lxmf_destination = RNS.Destination(destination_identity, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+            cached_at = now
+            self._out_dest_pool[(destination_hash, ratchet_id)] = lxmf_destination
+            self._out_dest_built_at[lxmf_destination] = cached_at
+
+        self._dest_cache[destination_hash] = (cached_at, ratchet_id, lxmf_destination)
+        self._dest_cache.move_to_end(destination_hash)
+        if len(self._dest_cache) > self.max_cached_destinations:
+            self._dest_cache.popitem(last=False)
+        return lxmf_destination
+
+    def iter_online_nodes(self, max_age_seconds=60):
+        seen = set()
+        mark_seen = seen.add
+        interfaces = RNS.Transport.interfaces
+        path_table = RNS.Transport.path_table
+
+        # transport tables are mutated by the RNS threads, so only ever iterate over snapshots of them
+        for iface in tuple(interfaces):
+            for p in tuple(getattr(iface, "peers", None) or ()):
+                node_hash = p.hex()
+                if node_hash not in seen:
+                    mark_seen(node_hash)
+                    yield {"hash": node_hash, "interface": iface.name, "type": "peer"}
+
+        # path table timestamps are wall clock times set by RNS, so this is the one place time.time() is right
+        cutoff = time.time() - max_age_seconds
+        for dst_hash, (last_seen, via, hops, *_rest) in tuple(path_table.items()):
+            if last_seen < cutoff:
+                continue
+            node_hash = dst_hash.hex()
+            if node_hash not in seen:
+                mark_seen(node_hash)
+                yield {"hash": node_hash, "via": str(via), "hops": hops, "type": "path"}
+
+    def _get_outbound_stamp_cost(self, destination_hash: bytes) -> int | None:
+        now = time.monotonic()
+        cached = self._stamp_cache.get(destination_hash)
+        if cached is not None and now - cached[0] < self.stamp_cost_cache_seconds:
+            return cached[1]
+
+        # no stamp is needed while we hold a ticket for this peer
+        outbound_stamp_cost = None
+        if self.message_router.get_outbound_ticket(destination_hash) is None:
+            outbound_stamp_cost = self.message_router.get_outbound_stamp_cost(destination_hash)
 
-        now = time.time()
-        for dst_hash, path_info in RNS.Transport.path_table.items():
-            last_seen = path_info[0]
-            if now - last_seen <= max_age_seconds:
-                nodes[dst_hash.hex()] = {"via": str(path_info[1]), "hops": path_info[2], "type": "path"}
+        self._prune_expired(self._stamp_cache, lambda cached: now - cached[0] >= self.stamp_cost_cache_seconds)
+        self._stamp_cache[destination_hash] = (now, outbound_stamp_cost)
+        return outbound_stamp_cost
+
+    def get_online_nodes_full(self, max_age_seconds=60):
+        # serve repeated calls from a short lived cache, handing out copies so callers can't alter it
+        now = time.monotonic()
+        built_at, built_max_age_seconds, nodes = self._nodes_cache
+        if built_max_age_seconds != max_age_seconds or now - built_at >= self.online_nodes_cache_seconds:
+            nodes = list(self.iter_online_nodes(max_age_seconds))
+            self._nodes_cache = (now, max_age_seconds, nodes)
 
-        return list(nodes.values())
+        return [dict(node) for node in nodes]
 
     def on_lxmf_message_received(self, lxmf_message: LXMF.LXMessage):
+        # LXMF can still deliver while we shut down, after the loop is gone
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.inbound_queue.put_nowait, lxmf_message)
+
+    async def inbound_worker(self):
+        while True:
+            lxmf_message = await self.inbound_queue.get()
+            try:
+                await self.handle_inbound(lxmf_message)
+            except Exception:
+                log.exception("Failed to handle message from %s", lxmf_message.source_hash.hex())
+            finally:
+                self.inbound_queue.task_done()
+
+    async def handle_inbound(self, lxmf_message: LXMF.LXMessage):
+        has_path = RNS.Transport.has_path
+        message_router = self.message_router
         destination_hash = lxmf_message.source_hash
-        print(f"📨 Received message from {destination_hash.hex()}: {lxmf_message.content_as_string()}")
-
-        if not RNS.Transport.has_path(destination_hash):
-            print(f"Requesting path to {destination_hash.hex()}")
-            RNS.Transport.request_path(destination_hash)
-            timeout_after_seconds = time.time() + self.path_lookup_timeout_seconds
-            while not RNS.Transport.has_path(destination_hash) and time.time() < timeout_after_seconds:
-                time.sleep(0.1)
-
-        destination_identity = RNS.Identity.recall(destination_hash)
-        if destination_identity is None:
-            print(f"Path not found, unable to reply to {destination_hash.hex()}")
+        dst_hex = destination_hash.hex()
+        content = lxmf_message.content_as_string()
+        log.info("📨 Received message from %s: %s", dst_hex, content)
+
+        # don't wait on another path lookup for a sender we recently failed to find
+        if time.monotonic() < self._neg_path_cache.get(destination_hash, 0):
+            log.info("Skipping %s, path recently not found", dst_hex)
             return
 
-        lxmf_destination = RNS.Destination(destination_identity, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+        if not has_path(destination_hash):
+            path_event = self._path_events.get(destination_hash)
+            if path_event is not None:
+                # a lookup for this sender is already in flight, share its outcome
+                await path_event.wait()
+            else:
+                log.info("Requesting path to %s", dst_hex)
+                path_event = self._path_events[destination_hash] = asyncio.Event()
+                try:
+                    RNS.Transport.request_path(destination_hash)
+                    # wait for the announce handler, but also re-check the path table with exponential back-off,
+                    # since the path is usable before RNS gets round to calling announce handlers
+                    deadline = self.loop.time() + self.path_lookup_timeout_seconds
+                    delay = 0.01
+                    while not has_path(destination_hash) and not path_event.is_set():
+                        remaining = deadline - self.loop.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            await asyncio.wait_for(path_event.wait(), min(delay, remaining))
+                        except asyncio.TimeoutError:
+                            delay = min(delay * 2, 1.0)
+                finally:
+                    del self._path_events[destination_hash]
+                    path_event.set()
+
+        ratchet_id = RNS.Identity.current_ratchet_id(destination_hash)
+        lxmf_destination = self._get_out_destination(destination_hash, ratchet_id)
+        if lxmf_destination is None:
+            log.warning("Path not found, unable to reply to %s", dst_hex)
+            self._cache_path_not_found(destination_hash)
+            return
 
-        if self.max_outbound_stamp_cost is not None and self.message_router.get_outbound_ticket(destination_hash) is None:
-            outbound_stamp_cost = self.message_router.get_outbound_stamp_cost(destination_hash)
+        if self.max_outbound_stamp_cost is not None:
+            outbound_stamp_cost = self._get_outbound_stamp_cost(destination_hash)
             if outbound_stamp_cost and outbound_stamp_cost > self.max_outbound_stamp_cost:
-                print(f"Not replying due to high stamp cost ({outbound_stamp_cost})")
+                log.info("Not replying due to high stamp cost (%s)", outbound_stamp_cost)
                 return
 
+        # don't bother building a reply that has no way of being delivered, opportunistic delivery can go without a path
+        delivery_link_available = message_router.delivery_link_available(destination_hash)
+        if not delivery_link_available and ratchet_id is None and not has_path(destination_hash):
+            log.warning("No path or link to %s, dropping reply", dst_hex)
+            return
+
         desired_delivery_method = LXMF.LXMessage.DIRECT
-        if not self.message_router.delivery_link_available(destination_hash) and RNS.Identity.current_ratchet_id(destination_hash) is not None:
+        if not delivery_link_available and ratchet_id is not None:
             desired_delivery_method = LXMF.LXMessage.OPPORTUNISTIC
 
-        reply_text = "Reply from echo bot\n\n"
+        signal_text = ""
         if lxmf_message.rssi is not None and lxmf_message.snr is not None:
-            reply_text += f"Received RSSI: {lxmf_message.rssi}, SNR: {lxmf_message.snr}\n\n"
-        reply_text += f"Content: {lxmf_message.content_as_string()}\n"
+            signal_text = f"Received RSSI: {lxmf_message.rssi}, SNR: {lxmf_message.snr}\n\n"
+        reply_text = f"Reply from echo bot\n\n{signal_text}Content: {content}\n"
 
         lxmf_message_reply = LXMF.LXMessage(
             destination=lxmf_destination,
@@ -116,14 +354,16 @@ class EchoBot:
         lxmf_message_reply.register_delivery_callback(self.on_lxmf_sending_success)
         lxmf_message_reply.register_failed_callback(self.on_lxmf_sending_failed)
 
-        print(f"📤 Sending reply to {destination_hash.hex()}")
-        self.message_router.handle_outbound(lxmf_message_reply)
+        log.info("📤 Sending reply to %s", dst_hex)
+        message_router.handle_outbound(lxmf_message_reply)
 
     def on_lxmf_sending_success(self, lxmf_message: LXMF.LXMessage):
-        print(f"✅ Successfully sent reply to {lxmf_message.destination_hash.hex()}")
+        # a delivered message may have brought us a ticket, or a new stamp cost
+        self._stamp_cache.pop(lxmf_message.destination_hash, None)
+        log.info("✅ Successfully sent reply to %s", lxmf_message.destination_hash.hex())
 
     def on_lxmf_sending_failed(self, lxmf_message: LXMF.LXMessage):
-        print(f"❌ Failed to send reply to {lxmf_message.destination_hash.hex()}")
+        log.warning("❌ Failed to send reply to %s", lxmf_message.destination_hash.hex())
 
 
 if __name__ == "__main__":
@@ -134,15 +374,24 @@ if __name__ == "__main__":
     parser.add_argument("--max-outbound-stamp-cost", type=int)
     args = parser.parse_args()
 
+    # Hand log records to a background thread, so message handling never blocks on writing to stdout
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    log_listener.start()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(logging.INFO)
+
+    import_reticulum()
+
     if not os.path.exists(args.identity_file):
         identity = RNS.Identity(create_keys=True)
         with open(args.identity_file, "wb") as file:
             file.write(identity.get_private_key())
-        print(f"Generated new identity: {identity.hash.hex()}")
+        log.info("Generated new identity: %s", identity.hash.hex())
 
     identity = RNS.Identity(create_keys=False)
     identity.load(args.identity_file)
-    print(f"Loaded identity: {identity.hash.hex()}")
+    log.info("Loaded identity: %s", identity.hash.hex())
 
     echobot = EchoBot(
         identity=identity,
@@ -151,5 +400,7 @@ if __name__ == "__main__":
         max_outbound_stamp_cost=args.max_outbound_stamp_cost,
     )
 
-    loop = asyncio.new_event_loop()
-    loop.run_forever()
+    try:
+        echobot.run()
+    finally:
+        log_listener.stop()